@@ -15,10 +15,13 @@
 #
 
 
+import abc
 import os
 import shutil
 import StringIO
+import sys
 import tempfile
+import threading
 import unittest
 
 
@@ -194,6 +197,49 @@ class DataBindingNodeTest(BaseTest):
         node.maybe = {}
         self.failUnlessRaises(xmllib.XmlLibError, binder.toXml, node)
 
+    def testSlotBasedMetaclass(self):
+        # Subclasses can have their own metaclass
+        class S(xmllib.SlotBasedSerializableObject):
+            __metaclass__ = abc.ABCMeta
+            tag = 'Blah'
+            __slots__ = ['attr1', 'child1']
+
+        class T(S):
+            __slots__ = ['attr1', 'attr2', 'child1']
+
+        binder = xmllib.DataBinder()
+        node = S()
+        node.attr1 = 1
+        node.child1 = xmllib.StringNode().characters('Maybe')
+        self.assertXMLEquals(binder.toXml(node, prettyPrint = False),
+            '<Blah attr1="1"><string>Maybe</string></Blah>')
+
+        node = T()
+        node.attr1 = 1
+        node.attr2 = True
+        node.child1 = xmllib.StringNode().characters('Maybe')
+        self.assertXMLEquals(binder.toXml(node, prettyPrint = False),
+            '<Blah attr1="1" attr2="true"><string>Maybe</string></Blah>')
+
+    def testSlotBasedFieldTypes(self):
+        class S(xmllib.SlotBasedSerializableObject):
+            tag = 'Blah'
+            __slots__ = ['attr1', 'attr2', 'child1']
+            _fieldTypes = dict(attr1 = int, attr2 = bool)
+
+        binder = xmllib.DataBinder()
+
+        node = S()
+        node.attr1 = 1
+        node.attr2 = None
+        node.child1 = xmllib.StringNode().characters('Maybe')
+        self.assertXMLEquals(binder.toXml(node, prettyPrint = False),
+            '<Blah attr1="1"><string>Maybe</string></Blah>')
+
+        node.attr2 = False
+        self.assertXMLEquals(binder.toXml(node, prettyPrint = False),
+            '<Blah attr1="1" attr2="false"><string>Maybe</string></Blah>')
+
     def testSlotBasedEq(self):
         class WithSlots(xmllib.SlotBasedSerializableObject):
             tag = "something"
@@ -218,6 +264,26 @@ class DataBindingNodeTest(BaseTest):
         self.failUnlessRaises(xmllib.UndefinedNamespaceError,
                               xmllib.BaseNode, attrs)
 
+    def testFromLxml(self):
+        # Attributes already split the way lxml reports them
+        node = xmllib.BaseNode._fromLxml({'ns' : 'a'}, {None : 'b'},
+            {(None, 'attr1') : 'val1', ('ns', 'attr2') : 'val2',
+             ('xml', 'base') : 'val3'}, 'ns:foo')
+        self.failUnlessEqual(node.getName(), 'ns:foo')
+        self.failUnlessEqual(node.getAbsoluteName(), '{a}foo')
+        self.failUnlessEqual(node.getAttribute('attr1'), 'val1')
+        self.failUnlessEqual(node.getAttributeByNamespace('attr2', 'a'),
+            'val2')
+        self.failUnlessEqual(node.getAttributeByNamespace('base',
+            xmllib.DataBinder.xmlBaseNamespace), 'val3')
+        ref = xmllib.BaseNode({'xmlns:ns' : 'a'}).getNamespaceMap()
+        node2 = xmllib.BaseNode(
+            {'xmlns' : 'b', 'attr1' : 'val1', 'ns:attr2' : 'val2',
+             'xml:base' : 'val3'}, nsMap = ref, name = 'ns:foo')
+        self.failUnlessEqual(sorted(node.iterAttributes()),
+            sorted(node2.iterAttributes()))
+        self.failUnlessEqual(node.getNamespaceMap(), node2.getNamespaceMap())
+
     def testCreateElementTree(self):
         attrs = {'{a}attr1' : 'val1', 'xmlns' : 'b'}
         ns = {'ns' : 'a'}
@@ -292,6 +358,21 @@ class DataBindingNodeTest(BaseTest):
         node.characters('foo')
         self.assertEquals(node.finalize(), 'foo')
 
+    def testCharactersInPieces(self):
+        node = xmllib.StringNode()
+        for ch in [u'f', u'o', u'o']:
+            node.characters(ch)
+        self.assertEquals(node.finalize(), 'foo')
+        node.characters(u'bar')
+        self.assertEquals([ x for x in node.iterChildren() ], ['foobar'])
+
+        node = xmllib.BaseNode(name = 'node')
+        node.characters(u'some ')
+        node.characters(u'text')
+        node.addChild(xmllib.BaseNode(name = 'child'))
+        self.assertEquals([ x.getName() for x in node.iterChildren() ],
+            ['child'])
+
     def testBooleanNode(self):
         node = xmllib.BooleanNode()
         node.characters('true')
@@ -353,6 +434,15 @@ class ContentHandlerTest(BaseTest):
         self.failUnlessRaises(xmllib.InvalidXML,
             binder.parseString, data)
 
+    def testInvalidDataReuseBinder(self):
+        # A document that fails to parse doesn't affect the next one
+        for useSax in [False, True]:
+            binder = xmllib.DataBinder(useSax = useSax)
+            self.failUnlessRaises(xmllib.InvalidXML,
+                binder.parseString, "<foo><bar>")
+            obj = binder.parseString("<baz/>")
+            self.assertEquals(obj.getName(), 'baz')
+
     def testToplevelNode(self):
         # Some invalid XML
         data = "vadfadfadf"
@@ -409,6 +499,116 @@ class ContentHandlerTest(BaseTest):
         assert isinstance(hdlr.stack[1], xmllib.GenericNode)
         self.assertEquals(hdlr.stack[1].getAttribute('attr1'), '1')
 
+    def testStartElementLxmlPrimitive(self):
+        # No node is built for the primitive types
+        hdlr = xmllib.BindingHandler({(None, 'int'): xmllib.IntegerNode,
+            (None, 'bool'): xmllib.BooleanNode})
+        hdlr._startElementLxml('foo', {}, {})
+        for name, text in [('int', u'3'), ('bool', u'true'), ('int', None)]:
+            hdlr._startElementLxml(name, {}, {})
+            self.failIf(isinstance(hdlr.stack[-1], xmllib.BaseNode))
+            if text is not None:
+                hdlr.characters(text)
+            hdlr.endElement(name)
+        hdlr.endElement('foo')
+        self.assertEquals(list(hdlr.rootNode.iterChildren()), [3, True, 0])
+
+    def testStartElementLxmlPrimitiveAddChild(self):
+        # Classes with their own addChild get the full node
+        class Node(xmllib.BaseNode):
+            def addChild(slf, childNode):
+                assert isinstance(childNode, xmllib.IntegerNode)
+                slf.value = (childNode.getText(), childNode.getAttribute('a'))
+
+        hdlr = xmllib.BindingHandler({(None, 'foo'): Node,
+            (None, 'int'): xmllib.IntegerNode})
+        hdlr._startElementLxml('foo', {}, {})
+        hdlr._startElementLxml('int', {}, {(None, 'a'): 'b'})
+        self.failUnless(isinstance(hdlr.stack[-1], xmllib.IntegerNode))
+        hdlr.characters(u'3')
+        hdlr.endElement('int')
+        hdlr.endElement('foo')
+        self.assertEquals(hdlr.rootNode.value, (u'3', 'b'))
+
+    def testCustomInit(self):
+        # Classes with their own __init__ get the attributes up front, with
+        # either parser
+        class Node(xmllib.BaseNode):
+            def __init__(slf, *args, **kwargs):
+                xmllib.BaseNode.__init__(slf, *args, **kwargs)
+                slf.id = slf.getAttribute('id')
+
+        class Other(xmllib.BaseNode):
+            def __init__(slf, attrs, *args, **kwargs):
+                xmllib.BaseNode.__init__(slf, attrs, *args, **kwargs)
+                slf.attrs = dict(attrs)
+
+        typeDict = {(None, 'n'): Node, (None, 'o'): Other}
+        saxEvents = [('n', {'id' : '7'}),
+            ('o', {'a:x' : '1', 'xmlns:b' : 'http://b'})]
+        lxmlEvents = [('n', {}, {(None, 'id') : '7'}),
+            ('o', {'b' : 'http://b'}, {('a', 'x') : '1'})]
+        for startElement, events in [('startElement', saxEvents),
+                ('_startElementLxml', lxmlEvents)]:
+            hdlr = xmllib.BindingHandler(typeDict)
+            hdlr.startElement('r', {'xmlns:a' : 'http://a'})
+            for event in events:
+                getattr(hdlr, startElement)(*event)
+                hdlr.endElement(event[0])
+            hdlr.endElement('r')
+            n, o = hdlr.rootNode.iterChildren()
+            self.failUnlessEqual(n.id, '7')
+            self.failUnlessEqual(n.getName(), 'n')
+            self.failUnlessEqual(o.attrs,
+                {'a:x' : '1', 'xmlns:b' : 'http://b'})
+            self.failUnlessEqual(o.getAttribute('x', 'a'), '1')
+
+    def testStartElementCustomNode(self):
+        # Registered classes only need to implement the node interface
+        class Node(object):
+            def __init__(slf, attrs, nsMap = None):
+                slf.nsMap = dict(nsMap)
+                slf.nsMap.update((k[6:], v) for k, v in attrs.items()
+                    if k.startswith('xmlns:'))
+                slf.children = []
+            def setName(slf, name):
+                slf.name = name
+            def getName(slf):
+                return slf.name
+            def getNamespaceMap(slf):
+                return slf.nsMap.copy()
+            def addChild(slf, childNode):
+                slf.children.append(childNode.finalize())
+            def characters(slf, ch):
+                pass
+            def finalize(slf):
+                return slf
+
+        hdlr = xmllib.BindingHandler({(None, 'foo'): Node})
+        hdlr.startElement('foo', {'xmlns:a' : 'nsA'})
+        hdlr.startElement('a:bar', {})
+        self.assertEquals(hdlr.stack[1].getNamespaceMap(), {'a' : 'nsA'})
+        hdlr.endElement('a:bar')
+        hdlr._startElementLxml('a:baz', {}, {})
+        hdlr.endElement('a:baz')
+        hdlr.endElement('foo')
+        self.assertEquals([ x.getName() for x in hdlr.rootNode.children ],
+            ['a:bar', 'a:baz'])
+
+    def testStartElementNamespaces(self):
+        # Namespaces declared by a node don't leak to its parent or siblings
+        hdlr = xmllib.BindingHandler()
+        hdlr.startElement('foo', {'xmlns:a' : 'nsA'})
+        hdlr.startElement('a:bar', {'xmlns:b' : 'nsB'})
+        self.assertEquals(hdlr.stack[1].getNamespaceMap(),
+            {'a' : 'nsA', 'b' : 'nsB'})
+        hdlr.endElement('a:bar')
+        hdlr.startElement('baz', {})
+        self.assertEquals(hdlr.stack[1].getNamespaceMap(), {'a' : 'nsA'})
+        self.failUnlessRaises(xmllib.UndefinedNamespaceError,
+            hdlr.startElement, 'b:baz', {})
+        self.assertEquals(hdlr.stack[0].getNamespaceMap(), {'a' : 'nsA'})
+
     def testEndElement1(self):
         hdlr = xmllib.BindingHandler()
         node1 = xmllib.BaseNode(name = 'foo')
@@ -478,17 +678,26 @@ class ContentHandlerTest(BaseTest):
         xml = "<root>%s</root>" % ''.join(
             "<pkg><val>%s</val></pkg>" % i for i in vals)
 
-        hdlr = xmllib.StreamingDataBinder()
-        hdlr.registerType(Root, name = "root")
-        hdlr.registerType(Pkg, name = "pkg")
-        hdlr.registerType(Val, name = "val")
-
-        it = hdlr.parseString(xml)
-        self.failUnlessEqual([ x.val for x in it ], vals)
-
+        for useSax in [False, True]:
+            hdlr = xmllib.StreamingDataBinder(useSax = useSax)
+            hdlr.registerType(Root, name = "root")
+            hdlr.registerType(Pkg, name = "pkg")
+            hdlr.registerType(Val, name = "val")
+
+            it = hdlr.parseString(xml)
+            self.failUnlessEqual([ x.val for x in it ], vals)
+
+            sio = StringIO.StringIO(xml)
+            # Same deal with a tiny buffer size, to make sure we're
+            # incrementally parsing
+            it = hdlr.parseFile(sio)
+            it.BUFFER_SIZE = 2
+            self.failUnlessEqual(it.next().val, 0)
+            self.failUnless(sio.tell() < len(xml))
+            self.failUnlessEqual([ x.val for x in it ], vals[1:])
+
+        # The SAX parser lets us check exactly how far we've read
         sio = StringIO.StringIO(xml)
-        # Same deal with a tiny buffer size, to make sure we're incrementally
-        # parsing
         it = hdlr.parseFile(sio)
         it.BUFFER_SIZE = 2
         self.failUnlessEqual(it.next().val, 0)
@@ -503,6 +712,38 @@ class ContentHandlerTest(BaseTest):
         self.failUnlessEqual(it.next().val, 3)
         self.failUnlessEqual(it.parser.getColumnNumber(), 98)
 
+    def testStreamingLongGap(self):
+        # More reads without a node to yield than the recursion limit
+        class Pkg(xmllib.BaseNode):
+            WillYield = True
+
+        xml = "<root>%s<pkg/></root>" % ("<a/>" * sys.getrecursionlimit())
+        hdlr = xmllib.StreamingDataBinder()
+        hdlr.registerType(Pkg, name = "pkg")
+        it = hdlr.parseFile(StringIO.StringIO(xml))
+        it.BUFFER_SIZE = 1
+        self.failUnlessEqual([ x.getName() for x in it ], ['pkg'])
+
+    def testStreamingTree(self):
+        # Validated documents are bound from their tree, as lazily as from
+        # a stream; nodes finalized to None are skipped
+        class Pkg(xmllib.BaseNode):
+            WillYield = True
+            def finalize(slf):
+                if slf.getAttribute('skip'):
+                    return None
+                return slf
+
+        count = 5000
+        xml = '<root><pkg skip="1"/>%s<pkg skip="1"/></root>' % (
+            '<pkg/>' * count)
+        hdlr = xmllib.StreamingDataBinder()
+        hdlr.registerType(Pkg, name = "pkg")
+        it = hdlr._parseTree(etree.fromstring(xml))
+        self.failUnlessEqual(it.next().getName(), 'pkg')
+        self.failUnless(len(hdlr.contentHandler.generatedNodes) < count)
+        self.failUnlessEqual(len(list(it)), count - 1)
+
 class BinderTest(BaseTest):
     def testBinderRegisterType(self):
         binder = xmllib.DataBinder()
@@ -534,6 +775,56 @@ class BinderTest(BaseTest):
         self.assertEquals(obj.bar, 'test')
         self.assertEquals(obj.getName(), 'baz')
 
+    def testParseStringUseSax(self):
+        data = '\n'.join(('<?xml version="1.0" encoding="UTF-8"?>',
+            '<gah:root xmlns="http://example.com"'
+                ' xmlns:gah="http://exmaple.com/gah" xml:base="media://foo">',
+            '  <gah:baz gah:attr="1">More text</gah:baz>',
+            '  <foo>3</foo>',
+            '</gah:root>'))
+        for useSax in [False, True]:
+            binder = xmllib.DataBinder(useSax = useSax)
+            obj = binder.parseString(data)
+            self.failUnlessEqual(obj.getName(), 'gah:root')
+            self.failUnlessEqual(obj.getAttribute('base', 'xml'),
+                'media://foo')
+            baz = obj.getChildren('baz', 'gah')[0]
+            self.failUnlessEqual(baz.getText(), 'More text')
+            self.failUnlessEqual(baz.getAttribute('attr', 'gah'), '1')
+            self.failUnlessEqual(obj.getChildren('foo')[0].getText(), '3')
+            self.assertXMLEquals(binder.toXml(obj), data)
+
+    def testParseStringAttributePrefixes(self):
+        # lxml only keeps the namespace of attributes, with several prefixes
+        # for it the first one is used
+        data = '<r xmlns:b="u" xmlns:a="u" b:x="1"/>'
+        for useSax, prefix in [(False, 'a'), (True, 'b')]:
+            obj = xmllib.DataBinder(useSax = useSax).parseString(data)
+            self.failUnlessEqual(obj.getAttribute('x', prefix), '1')
+            self.failUnlessEqual(obj.getAttributeByNamespace('x', 'u'), '1')
+        # Undefined prefixes are reported the same way by both parsers
+        for data in ['<r b:x="1"/>', '<r><b:c/></r>']:
+            for useSax in [False, True]:
+                binder = xmllib.DataBinder(useSax = useSax)
+                e = self.failUnlessRaises(xmllib.UndefinedNamespaceError,
+                    binder.parseString, data)
+                self.failUnlessEqual(str(e), 'b')
+
+    def testParseStringComments(self):
+        # Comments and processing instructions don't split the text
+        for useSax in [False, True]:
+            binder = xmllib.DataBinder(useSax = useSax)
+            binder.registerType(xmllib.StringNode, 'bar')
+            obj = binder.parseString('<r>a<!-- c -->b</r>')
+            self.failUnlessEqual(obj.getText(), 'ab')
+            obj = binder.parseString('<r><!-- c -->t</r>')
+            self.failUnlessEqual(obj.getText(), 't')
+            obj = binder.parseString('<r><!-- c -->a<?p x?>b<foo/></r>')
+            self.failUnlessEqual(obj.getText(), '')
+            obj = binder.parseString(
+                '<r><bar>x<!-- c -->y<?p x?>z</bar></r>')
+            self.failUnlessEqual(list(obj.iterChildren()), ['xyz'])
+
     def testRoundTripGenericParsing(self):
         binder = xmllib.DataBinder()
         data = '<baz><foo>3</foo><bar>test</bar></baz>'
@@ -566,6 +857,28 @@ class BinderTest(BaseTest):
         self.assertEquals(obj.bar, None)
         self.assertEquals(obj.getName(), 'baz')
 
+    def testParseFileNotSeekable(self):
+        class Stream(object):
+            def __init__(self, data):
+                self.read = StringIO.StringIO(data).read
+            def seekable(self):
+                return False
+
+        binder = xmllib.DataBinder()
+        obj = binder.parseFile(Stream('<baz><foo>3</foo></baz>'))
+        self.failUnlessEqual(obj.getName(), 'baz')
+        self.failUnlessEqual([ x.getText() for x in obj.iterChildren() ],
+            ['3'])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            file(os.path.join(tmpdir, "schema.xsd"), "w+").write(xmlSchema1)
+            obj = binder.parseFile(Stream(xmlData1), validate = True,
+                schemaDir = tmpdir)
+            self.failUnlessEqual(obj.getName(), 'f')
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
     def testIterChildren(self):
         binder = xmllib.DataBinder()
         class Foo(xmllib.BaseNode):
@@ -693,6 +1006,99 @@ class BinderTest(BaseTest):
 </toplevel>
 """)
 
+    def testWriteTo(self):
+        binder = xmllib.DataBinder()
+        class ListObj(xmllib.SerializableList):
+            tag = "toplevel"
+
+        class Node1(xmllib.SlotBasedSerializableObject):
+            __slots__ = [ 'attr1', 'attr2', 'children' ]
+            tag = "node1"
+
+        l1 = ListObj()
+        n1 = Node1()
+        l1.append(n1)
+        n1.attr1 = "attrVal11"
+        n1.attr2 = True
+        n1.children = xmllib.StringNode(name = "child11").characters("text 11")
+
+        sio = StringIO.StringIO()
+        l1.writeTo(sio)
+        self.assertXMLEquals(sio.getvalue(), binder.toXml(l1))
+
+        data = ('<gah:root-node xmlns="http://example.com"'
+            ' xmlns:gah="http://exmaple.com/gah">'
+            '<gah:baz attr="1">More text</gah:baz><foo/></gah:root-node>')
+        obj = binder.parseString(data)
+        sio = StringIO.StringIO()
+        obj.writeTo(sio)
+        self.assertXMLEquals(sio.getvalue(), data)
+
+        # The xml prefix is kept, and declared only once
+        data = ('<root xml:base="media://foo">'
+            '<baz xml:lang="en">More text</baz></root>')
+        obj = binder.parseString(data)
+        sio = StringIO.StringIO()
+        obj.writeTo(sio)
+        self.failUnlessEqual(sio.getvalue().count('xmlns:xml='), 1)
+        self.failIf('ns0' in sio.getvalue())
+        self.assertXMLEquals(sio.getvalue(), data)
+
+        # Errors close the elements already open
+        class Broken(xmllib.BaseNode):
+            def getElementTree(slf, parent = None):
+                raise RuntimeError('broken')
+
+        obj = xmllib.GenericNode().setName('root')
+        obj.addChild(xmllib.GenericNode().setName('baz'))
+        obj.addChild(Broken().setName('broken'))
+        sio = StringIO.StringIO()
+        self.failUnlessRaises(RuntimeError, obj.writeTo, sio)
+        self.failUnless(sio.getvalue().endswith('</baz></root>'),
+            sio.getvalue())
+
+        # Deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 100
+        top = node = xmllib.GenericNode().setName('node')
+        for i in range(depth):
+            child = xmllib.GenericNode().setName('node')
+            node.addChild(child)
+            node = child
+        node.characters('leaf')
+        sio = StringIO.StringIO()
+        top.writeTo(sio)
+        elems = list(etree.fromstring(sio.getvalue(),
+            etree.XMLParser(huge_tree = True)).iter('node'))
+        self.failUnlessEqual(len(elems), depth + 1)
+        self.failUnlessEqual(elems[-1].text, 'leaf')
+
+    def testToXmlStream(self):
+        binder = xmllib.DataBinder()
+        data = ('<gah:root-node xmlns="http://example.com"'
+            ' xmlns:gah="http://exmaple.com/gah">'
+            '<gah:baz attr="1">More text</gah:baz><foo/></gah:root-node>')
+        obj = binder.parseString(data)
+        for prettyPrint in [True, False]:
+            sio = StringIO.StringIO()
+            binder.toXmlStream(obj, sio, prettyPrint = prettyPrint)
+            self.failUnless(sio.getvalue().startswith('<?xml'))
+            self.assertXMLEquals(sio.getvalue(), data)
+
+    def testToXmlDeep(self):
+        # Deeper than the recursion limit
+        depth = sys.getrecursionlimit() + 100
+        top = node = xmllib.GenericNode().setName('node')
+        for i in range(depth):
+            child = xmllib.GenericNode().setName('node')
+            node.addChild(child)
+            node = child
+        node.characters('leaf')
+
+        elem = top.getElementTree()
+        elems = list(elem.iter('node'))
+        self.failUnlessEqual(len(elems), depth + 1)
+        self.failUnlessEqual(elems[-1].text, 'leaf')
+
     def testToXmlUnicode(self):
 
         class Foo(xmllib.BaseNode):
@@ -846,6 +1252,13 @@ class RoundTripTest(BaseTest):
         newData = binder.toXml(obj)
         self.assertXMLEquals(newData, data)
 
+        # Subclasses may change the children directly
+        names = [ x.getName() for x in obj.iterChildren() ]
+        self.failUnlessEqual(names, ['baz', 'bar'])
+        obj._children.append(xmllib.GenericNode(name = 'bar'))
+        names = [ x.getName() for x in obj.iterChildren() ]
+        self.failUnlessEqual(names, ['baz', 'bar', 'bar'])
+
     def testNamespaceSupport(self):
         binder = xmllib.DataBinder()
         data = '\n'.join(('<?xml version="1.0" encoding="UTF-8"?>',
@@ -1018,6 +1431,47 @@ class SchemaValidationTest(BaseTest):
         self.failUnlessEqual(str(e), "Schema directory `%s' not found" %
             tmpdir)
 
+    def testChooseSchemaFileCache(self):
+        tmpdir = tempfile.mkdtemp()
+        origListdir = os.listdir
+        calls = []
+        def listdir(path):
+            calls.append(path)
+            return origListdir(path)
+        try:
+            os.listdir = listdir
+            file(os.path.join(tmpdir, "sf1"), "w")
+            # Recently modified directories are listed every time
+            for i in range(2):
+                ret = xmllib.DataBinder.chooseSchemaFile(["sf0", "sf1"], tmpdir)
+                self.failUnlessEqual(ret, os.path.join(tmpdir, "sf1"))
+            self.failUnlessEqual(len(calls), 2)
+
+            mtime = os.stat(tmpdir).st_mtime - 10
+            os.utime(tmpdir, (mtime, mtime))
+            for i in range(2):
+                ret = xmllib.DataBinder.chooseSchemaFile(["sf0", "sf1"], tmpdir)
+                self.failUnlessEqual(ret, os.path.join(tmpdir, "sf1"))
+            self.failUnlessEqual(len(calls), 3)
+
+            # A new file changes the directory's mtime
+            file(os.path.join(tmpdir, "sf0"), "w")
+            ret = xmllib.DataBinder.chooseSchemaFile(["sf0", "sf1"], tmpdir)
+            self.failUnlessEqual(ret, os.path.join(tmpdir, "sf0"))
+            self.failUnlessEqual(len(calls), 4)
+
+            # A single schema doesn't need the listing
+            ret = xmllib.DataBinder.chooseSchemaFile(["sf1"], tmpdir)
+            self.failUnlessEqual(ret, os.path.join(tmpdir, "sf1"))
+            e = self.failUnlessRaises(xmllib.UnknownSchemaError,
+                xmllib.DataBinder.chooseSchemaFile, ["sf2"], tmpdir)
+            self.failUnlessEqual(str(e),
+                "No applicable schema found in directory `%s'" % tmpdir)
+            self.failUnlessEqual(len(calls), 4)
+        finally:
+            os.listdir = origListdir
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
     def testClassLevelValidate(self):
         tmpdir = tempfile.mkdtemp()
         try:
@@ -1033,15 +1487,59 @@ class SchemaValidationTest(BaseTest):
         finally:
             shutil.rmtree(tmpdir, ignore_errors = True)
 
+    def testSchemaCache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            schemaFile = os.path.join(tmpdir, "schema.xsd")
+            file(schemaFile, "w+").write(xmlSchema1)
+            schema = xmllib.DataBinder._getSchema(schemaFile)
+            self.failUnless(xmllib.DataBinder._getSchema(schemaFile) is schema)
+
+            # The error log belongs to the last validation
+            stream = StringIO.StringIO(xmlData2)
+            e = self.failUnlessRaises(xmllib.SchemaValidationError,
+                xmllib.DataBinder.validate, stream, tmpdir)
+            self.failUnlessEqual(str(e), schemaError2)
+            xmllib.DataBinder.validate(StringIO.StringIO(xmlData1), tmpdir)
+
+            # Other threads get their own schema, and error log
+            schemas = []
+            thread = threading.Thread(target = lambda: schemas.append(
+                xmllib.DataBinder._getSchema(schemaFile)))
+            thread.start()
+            thread.join()
+            self.failIf(schemas[0] is schema)
+
+            # A modified schema gets compiled again
+            file(schemaFile, "w+").write(xmlSchema1 + "\n")
+            self.failIf(xmllib.DataBinder._getSchema(schemaFile) is schema)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors = True)
+
     def testParseFileValidate(self):
         tmpdir = tempfile.mkdtemp()
         stream = StringIO.StringIO(xmlData1)
         try:
             file(os.path.join(tmpdir, "schema.xsd"), "w+").write(xmlSchema1)
             binder = xmllib.DataBinder()
-            binder.parseFile(stream, validate = True, schemaDir = tmpdir)
-
-            binder.parseString(xmlData1, validate = True, schemaDir = tmpdir)
+            obj = binder.parseFile(stream, validate = True, schemaDir = tmpdir)
+            self.failUnlessEqual(obj.getName(), 'f')
+            self.failUnlessEqual([ x.getName() for x in obj.iterChildren() ],
+                ['c1', 'c2'])
+
+            obj = binder.parseString(xmlData1, validate = True,
+                schemaDir = tmpdir)
+            self.failUnlessEqual([ x.getName() for x in obj.iterChildren() ],
+                ['c1', 'c2'])
+
+            # The streaming binder still returns an iterator
+            class C1(xmllib.BaseNode):
+                WillYield = True
+            binder = xmllib.StreamingDataBinder()
+            binder.registerType(C1, name = 'c1')
+            it = binder.parseString(xmlData1, validate = True,
+                schemaDir = tmpdir)
+            self.failUnlessEqual([ x.getName() for x in it ], ['c1'])
 
             # Try to pass None as a schema directory - should fail
             stream.seek(0)
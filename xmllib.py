@@ -24,11 +24,16 @@ character are public interfaces.
 
 import os
 import sys
+import threading
+import time
 import StringIO
+import cStringIO
 from xml import sax
 
 from lxml import etree
 import collections
+import itertools
+import operator
 
 #{ Exception classes
 class XmlLibError(Exception):
@@ -50,6 +55,20 @@ class UnknownSchemaError(SchemaValidationError):
 
 #}
 
+# The name caches below are cleared when they reach this size, so that
+# parsing many documents with different names does not grow them forever
+_nameCacheSize = 1000
+# Cache of ElementTree-style names, keyed on (namespace, name)
+_elementTreeNames = {}
+# Cache of qualified names split into (namespace, name)
+_splitNames = {}
+# Cache of qualified names, keyed on (prefix, name)
+_qualifiedNames = {}
+# Cache of _getOrderPositions results for orderItems, keyed on the ordering
+_orderPositions = {}
+
+_stringTypes = frozenset((str, unicode))
+
 #{ Base classes
 class SerializableObject(object):
     """
@@ -68,25 +87,118 @@ class SerializableObject(object):
         @param parent: An optional parent object.
         @type parent: C{SerializableObject} instance
         """
+        root = self._createElement(parent)
+        # Walk the tree with a work list instead of recursing, so deep
+        # documents neither pay for a frame per node nor hit the recursion
+        # limit. Classes overriding getElementTree still get called.
+        pending = [ (self, root) ]
+        while pending:
+            obj, elem = pending.pop()
+            for child in obj._iterChildren():
+                # Check for the library's own classes first, hasattr is slower
+                if isinstance(child, SerializableObject):
+                    if (type(child).getElementTree.im_func is
+                            _defaultGetElementTree):
+                        pending.append((child, child._createElement(elem)))
+                    else:
+                        child.getElementTree(parent = elem)
+                elif isinstance(child, (str, unicode)):
+                    elem.text = child
+                elif hasattr(child, 'getElementTree'):
+                    child.getElementTree(parent = elem)
+        return root
+
+    def _createElement(self, parent):
+        """
+        Create the element for this object alone, without its children.
+        @param parent: An optional parent element.
+        @type parent: C{lxml.etree._Element} instance
+        @return: The new element
+        @rtype: C{lxml.etree._Element} instance
+        """
         name = self._getName()
-
+        attrs = self._getElementAttributes()
+
+        # Same as createElementTree. Most nodes declare no namespace, and
+        # lxml is happy with None for those
+        localNamespaces = self._getLocalNamespaces() or None
+        if parent is None:
+            return etree.Element(name, attrs, localNamespaces)
+        return etree.SubElement(parent, name, attrs, localNamespaces)
+
+    def writeTo(self, stream):
+        """
+        Write the XML document for this object to a stream.
+
+        Unlike C{getElementTree}, this doesn't build the whole tree in
+        memory: elements are written as they are produced. The output is
+        not pretty-printed, the C{xml} prefix is declared on the outermost
+        element using it, and depending on the lxml version, non-ASCII
+        characters in attribute values may be written as character
+        references.
+        @param stream: the stream (or the name of the file) to write to
+        @type stream: C{file} or C{str}
+        """
+        _writeDocument(self, stream)
+
+    def _openElement(self, xmlFile, xmlDeclared):
+        """
+        Prepare writing this object as an element of an incremental XML
+        writer
+        @param xmlFile: the writer
+        @type xmlFile: C{etree.xmlfile} context
+        @param xmlDeclared: whether an enclosing element declared the
+        C{xml} prefix
+        @type xmlDeclared: C{bool}
+        @return: the element's context, for the caller to enter and exit;
+        the element's text, or None; the children; and whether the prefix
+        is declared for the children
+        @rtype: C{tuple}
+        """
+        text = None
+        children = []
+        for child in self._iterChildren():
+            if isinstance(child, _serializableTypes):
+                children.append(child)
+            elif isinstance(child, (str, unicode)):
+                # getElementTree makes it the element's text, ahead of the
+                # children
+                text = child
+            elif hasattr(child, 'getElementTree'):
+                children.append(child)
+        attrs = self._getElementAttributes()
+        nsMap = self._getLocalNamespaces()
+        if nsMap and 'xml' in nsMap:
+            # Declared below when needed, and only once
+            nsMap = nsMap.copy()
+            del nsMap['xml']
+        if not xmlDeclared:
+            xmlPrefix = _xmlNamespacePrefix
+            for attrName in attrs:
+                if attrName.startswith(xmlPrefix):
+                    # Unlike tree serialization, xmlfile only writes the
+                    # xml prefix when it is in the mapping; it would make
+                    # up a prefix for the namespace otherwise
+                    nsMap = dict(nsMap or (), xml = DataBinder.xmlBaseNamespace)
+                    xmlDeclared = True
+                    break
+        context = xmlFile.element(self._getName(), attrs, nsMap or None)
+        return context, text, children, xmlDeclared
+
+    def _getElementAttributes(self):
+        "Return the attributes to serialize, converted to strings"
         attrs = {}
+        stringTypes = _stringTypes
         for attrName, attrVal in self._iterAttributes():
-            if isinstance(attrVal, bool):
-                attrVal = BooleanNode.toString(attrVal)
-            elif not isinstance(attrVal, (str, unicode)):
-                attrVal = str(attrVal)
+            # Most values are already strings; only check the exact type
+            # for those
+            if type(attrVal) not in stringTypes:
+                if isinstance(attrVal, bool):
+                    attrVal = BooleanNode.toString(attrVal)
+                elif not isinstance(attrVal, (str, unicode)):
+                    attrVal = str(attrVal)
             attrs[attrName] = attrVal
-
-        localNamespaces = self._getLocalNamespaces()
-
-        elem = createElementTree(name, attrs, localNamespaces, parent = parent)
-        for child in self._iterChildren():
-            if hasattr(child, 'getElementTree'):
-                child.getElementTree(parent = elem)
-            elif isinstance(child, (str, unicode)):
-                elem.text = child
-        return elem
+        return attrs
 
     def _getName(self):
         """
@@ -116,25 +228,72 @@ class SerializableObject(object):
         """
         raise NotImplementedError()
 
+_defaultGetElementTree = SerializableObject.getElementTree.im_func
+
 class _AbstractNode(SerializableObject):
     """Abstract node class for parsing XML data"""
     __slots__ = ('_children', '_nsMap', '_name', '_nsAttributes',
-                 '_otherAttributes', )
+                 '_otherAttributes', '_textBuf', )
+
+    # Names of the children that should be stored as attributes of the node
+    # instead of being added to the list of children
+    _singleChildren = frozenset()
+
+    # Names of the children, in the order they should be iterated over
+    _childOrder = None
+    # _childOrder and the positions computed from it by orderItems
+    _childOrderPositions = None
 
     def __init__(self, attributes = None, nsMap = None, name = None):
         SerializableObject.__init__(self)
         self._name = (None, name)
         self._children = []
-        self._nsMap = nsMap or {}
+        # Keep the (possibly empty) mapping we got: nodes never change it,
+        # they copy it before declaring namespaces
+        if nsMap is None:
+            nsMap = {}
+        self._nsMap = nsMap
         self._nsAttributes = {}
         self._otherAttributes = {}
+        self._textBuf = None
         self._setAttributes(attributes)
         if name is not None:
             self.setName(name)
 
+    @classmethod
+    def _fromLxml(cls, nsMap, nsAttributes, otherAttributes, name):
+        """
+        Alternate constructor for attributes already split by lxml, which
+        skips the xmlns parsing done in C{_setAttributes}.
+        @param nsMap: the namespace mapping inherited from the parent node
+        @type nsMap: C{dict}
+        @param nsAttributes: the namespaces declared by this node, keyed on
+        their alias (C{None} for the default namespace)
+        @type nsAttributes: C{dict}
+        @param otherAttributes: the node's attributes, keyed on
+        (namespaceAlias, name)
+        @type otherAttributes: C{dict}
+        @param name: the node's name
+        @type name: C{str}
+        @rtype: C{cls}
+        """
+        node = cls(nsMap = nsMap)
+        if (otherAttributes and 'xml' not in node._nsMap
+                and 'xml' not in nsAttributes):
+            for nsName, _ in otherAttributes:
+                if nsName == 'xml':
+                    # See _setAttributes for the bare xml: prefix
+                    nsAttributes[nsName] = DataBinder.xmlBaseNamespace
+                    break
+        if nsAttributes:
+            node._declareNamespaces(nsAttributes)
+        node._otherAttributes = otherAttributes
+        return node.setName(name)
+
     def setName(self, name):
         """Set the node's name"""
-        nsName, tagName = splitNamespace(name)
+        name = _internName(name)
+        nsName, tagName = _splitName(name)
         if nsName is not None and nsName not in self._nsMap:
             raise UndefinedNamespaceError(nsName)
         self._name = (nsName, tagName)
@@ -145,7 +304,10 @@ class _AbstractNode(SerializableObject):
         @return: the node's name
         @rtype: C{str}
         """
-        return unsplitNamespace(self._name[1], self._name[0])
+        nsName, tagName = self._name
+        if nsName is None:
+            return tagName
+        return _qualifiedName(nsName, tagName)
 
     def getAbsoluteName(self):
         """
@@ -154,10 +316,11 @@ class _AbstractNode(SerializableObject):
         @return: the node's absolute name
         @rtype: C{str}
         """
-        if self._name[0] is None and None not in self._nsMap:
+        nsName, tagName = self._name
+        if nsName is None and None not in self._nsMap:
             # No default namespace provided
-            return self._name[1]
-        return "{%s}%s" % (self._nsMap[self._name[0]], self._name[1])
+            return tagName
+        return _elementTreeName(self._nsMap[nsName], tagName)
 
     def addChild(self, childNode):
         """
@@ -166,22 +329,32 @@ class _AbstractNode(SerializableObject):
         @type childNode: Node
         """
         # If the previous node in the list is character data, drop it, since
-        # we don't support mixed content
-        if self._children and isinstance(self._children[-1], unicode):
-            self._children[-1] = childNode.finalize()
+        # we don't support mixed content. Parsers only produce unicode text,
+        # so an exact type check will do
+        children = self._children
+        if children and type(children[-1]) is unicode:
+            children[-1] = childNode.finalize()
+            self._textBuf = None
         else:
-            if childNode.getName() in getattr(self, '_singleChildren', []):
-                setattr(self, childNode.getName(), childNode.finalize())
+            name = childNode.getName()
+            if name in self._singleChildren:
+                setattr(self, name, childNode.finalize())
             else:
-                self._children.append(childNode.finalize())
+                children.append(childNode.finalize())
 
     def iterChildren(self):
         "Iterate over this node's children"
-        if hasattr(self, '_childOrder'):
-            # pylint: disable-msg=E1101
-            # no '_childOrder' member: we just tested for that
-            return orderItems(self._children, self._childOrder)
-        return iter(self._children)
+        if self._textBuf is not None:
+            self._flushText()
+        childOrder = self._childOrder
+        if childOrder is None or len(self._children) < 2:
+            return iter(self._children)
+        positions = self._childOrderPositions
+        if positions is None or positions[0] is not childOrder:
+            # Computed once per class
+            positions = (childOrder, _getOrderPositions(childOrder))
+            self.__class__._childOrderPositions = positions
+        return iter(_orderItems(self._children, positions[1]))
 
     def finalize(self):
         "Post-process this node (e.g. cast text to the expected type)"
@@ -194,13 +367,20 @@ class _AbstractNode(SerializableObject):
         @return: self
         @rtype: C{type(self)}
         """
-        if self._children:
-            if isinstance(self._children[-1], unicode):
-                self._children[-1] += ch
+        children = self._children
+        if children:
+            if type(children[-1]) is unicode:
+                # Parsers may hand us the text in many pieces; concatenating
+                # them one by one is quadratic, so collect them and join
+                # them when the text is needed
+                if self._textBuf is None:
+                    self._textBuf = [ children[-1], ch ]
+                else:
+                    self._textBuf.append(ch)
             # We don't support mixed contents, so don't bother adding
             # characters after children
         else:
-            self._children.append(ch)
+            children.append(ch)
         return self
 
     def getNamespaceMap(self):
@@ -213,16 +393,17 @@ class _AbstractNode(SerializableObject):
         @return: iterable of (attributeName, attributeValue)
         @rtype: iterable of (attributeName, attributeValue) strings
         """
-        for nsName, nsVal in sorted(self._nsAttributes.items()):
+        qualifiedName = _qualifiedName
+        for nsName, nsVal in self._sortedNamespaces():
             if nsName is None:
                 yield ('xmlns', nsVal)
             else:
-                yield ('xmlns:%s' % nsName, nsVal)
-        for (nsName, attrName), attrVal in self._otherAttributes.items():
+                yield (qualifiedName('xmlns', nsName), nsVal)
+        for (nsName, attrName), attrVal in self._otherAttributes.iteritems():
             if nsName is None:
                 yield (attrName, attrVal)
             else:
-                yield ("%s:%s" % (nsName, attrName), attrVal)
+                yield (qualifiedName(nsName, attrName), attrVal)
 
     def iterNamespaces(self):
         """
@@ -231,8 +412,7 @@ class _AbstractNode(SerializableObject):
         C{namespaceAlias} equal to {None} for the default namespace.
         @rtype: iterable of (namespaceAlias, namespaceValue) strings
         """
-        for nsName, nsVal in sorted(self._nsAttributes.items()):
-            yield nsName, nsVal
+        return iter(self._sortedNamespaces())
 
     def getAttribute(self, name, namespace = None):
         """
@@ -264,10 +444,10 @@ class _AbstractNode(SerializableObject):
             # Nothing different from getAttribute
             return self.getAttribute(name)
 
-        # Get all aliases that correspond to this namespace
-        aliases = [ x for (x, y) in self._nsMap.items() if y == namespace ]
-        # Sort them (this way the default namespace comes first)
-        aliases.sort()
+        # Get all aliases that correspond to this namespace. Sort them (this
+        # way the default namespace comes first)
+        aliases = sorted(x for (x, y) in self._nsMap.iteritems()
+            if y == namespace)
         for alias in aliases:
             if (alias, name) in self._otherAttributes:
                 return self._otherAttributes[(alias, name)]
@@ -286,22 +466,31 @@ class _AbstractNode(SerializableObject):
         """
         tagName = unsplitNamespace(name, namespace)
         return [ x for x in self.iterChildren()
-            if hasattr(x, 'getName') and x.getName() == tagName ]
+            if (isinstance(x, _AbstractNode) or hasattr(x, 'getName'))
+                and x.getName() == tagName ]
 
     def getText(self):
         "Return a node's character data"
-        text = [ x for x in self._children if isinstance(x, (str, unicode)) ]
-        if not text:
+        if self._textBuf is not None:
+            self._flushText()
+        children = self._children
+        if not children:
             return ''
-        return text[0]
+        # characters() only adds text to nodes with no children, so it's
+        # normally the first child
+        if isinstance(children[0], (str, unicode)):
+            return children[0]
+        return next((x for x in children if isinstance(x, (str, unicode))),
+            '')
 
     #{ Methods for serializing Node objects
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
     def _getName(self):
-        if self._name[0] is None:
-            return self._name[1]
-        return "{%s}%s" % (self._nsMap[self._name[0]], self._name[1])
+        nsName, tagName = self._name
+        if nsName is None:
+            return tagName
+        return _elementTreeName(self._nsMap[nsName], tagName)
 
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
@@ -311,8 +500,11 @@ class _AbstractNode(SerializableObject):
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
     def _iterAttributes(self):
-        for (nsName, attrName), attrVal in self._otherAttributes.items():
-            attrName = self._buildElementTreeName(attrName, nsName)
+        buildName = self._buildElementTreeName
+        for (nsName, attrName), attrVal in self._otherAttributes.iteritems():
+            # Most attributes have no namespace, and keep their name
+            if nsName is not None:
+                attrName = buildName(attrName, nsName)
             yield (attrName, attrVal)
 
     # pylint: disable-msg=C0111
@@ -328,42 +520,70 @@ class _AbstractNode(SerializableObject):
         self._otherAttributes = {}
         if attributes is None:
             return
-        nonNsAttr = []
+        nsAttributes = {}
+        otherAttributes = self._otherAttributes
+        internName = _internName
+        # Prefixed attributes are qualified once all the xmlns declarations
+        # have been seen; this is usually empty
+        prefixedAttr = []
+        # SAX attributes only have items(), not iteritems()
         for attrName, attrVal in attributes.items():
-            arr = attrName.split(':', 1)
-            if arr[0] != 'xmlns':
-                # Copy the tag aside, we may need to qualify it later
-                if len(arr) == 1:
-                    # No name space specified, use default
-                    attrKey = (None, attrName)
+            if ':' not in attrName:
+                # The common case, no prefix
+                if attrName == 'xmlns':
+                    nsAttributes[None] = internName(attrVal)
                 else:
-                    attrKey = tuple(arr)
-                nonNsAttr.append((attrKey, attrVal))
+                    # No name space specified, use default
+                    otherAttributes[(None, internName(attrName))] = attrVal
                 continue
-            if len(arr) == 1:
-                nsName = None
+            prefix, _, localName = attrName.partition(':')
+            if prefix == 'xmlns':
+                nsAttributes[internName(localName)] = internName(attrVal)
             else:
-                nsName = arr[1]
-            self._nsMap[nsName] = attrVal
-            self._nsAttributes[nsName] = attrVal
-        # Now walk all attributes and qualify them with the namespace if
-        # necessary
-        for (nsName, attrName), attrVal in nonNsAttr:
-            if nsName == 'xml' and nsName not in self._nsMap:
+                prefixedAttr.append((internName(prefix),
+                    internName(localName), attrVal))
+        for nsName, _, _ in prefixedAttr:
+            if (nsName == 'xml' and nsName not in self._nsMap
+                    and nsName not in nsAttributes):
                 # Bare xml: with no xmlns:xml specification
                 # Reading http://www.w3.org/TR/xmlbase/#syntax
                 # we'll assume that an undefined xml namespace prefix is
                 # bound to DataBinder.xmlBaseNamespace
-                self._nsMap[nsName] = self._nsAttributes[nsName] = DataBinder.xmlBaseNamespace
-            if nsName is not None and nsName not in self._nsMap:
+                nsAttributes[nsName] = DataBinder.xmlBaseNamespace
+                break
+        if nsAttributes:
+            self._declareNamespaces(nsAttributes)
+        nsMap = self._nsMap
+        for nsName, attrName, attrVal in prefixedAttr:
+            if nsName not in nsMap:
                 raise UndefinedNamespaceError(nsName)
-            self._otherAttributes[(nsName, attrName)] = attrVal
+            otherAttributes[(nsName, attrName)] = attrVal
+
+    def _declareNamespaces(self, nsAttributes):
+        "Add the namespaces declared by this node to its mapping"
+        # The mapping we got is shared with the parent node (and its other
+        # children), so copy it before changing it
+        nsMap = self._nsMap = self._nsMap.copy()
+        nsMap.update(nsAttributes)
+        self._nsAttributes = nsAttributes
+
+    def _sortedNamespaces(self):
+        "Return the namespaces declared by this node, sorted by alias"
+        # Most nodes declare at most one namespace, nothing to sort then
+        if len(self._nsAttributes) <= 1:
+            return self._nsAttributes.items()
+        return sorted(self._nsAttributes.iteritems())
+
+    def _flushText(self):
+        "Join the character data collected by characters()"
+        self._children[-1] = u''.join(self._textBuf)
+        self._textBuf = None
 
     def _buildElementTreeName(self, name, namespace = None):
         "Convenience function for building a namespace-qualified node name"
         if namespace is None:
             return name
-        return "{%s}%s" % (self._nsMap[namespace], name)
+        return _elementTreeName(self._nsMap[namespace], name)
     #}
 
 class BaseNode(_AbstractNode):
@@ -406,7 +626,14 @@ class IntegerNode(BaseNode):
 
     def finalize(self):
         "Convert the character data to an integer"
-        text = self.getText()
+        return self._fromText(self.getText())
+
+    @staticmethod
+    def _fromText(text):
+        "Convert character data to an integer"
+        # Empty elements are common enough; don't raise and catch for them
+        if not text:
+            return 0
         try:
             return int(text)
         except ValueError:
@@ -434,7 +661,11 @@ class StringNode(BaseNode):
 
     def finalize(self):
         "Convert the text data to a string"
-        text = self.getText()
+        return self._fromText(self.getText())
+
+    @staticmethod
+    def _fromText(text):
+        "Convert character data to a string"
         return text
 
     # pylint: disable-msg=C0111
@@ -460,11 +691,19 @@ class NullNode(BaseNode):
     def finalize(self):
         "Discard the character data"
 
+    @staticmethod
+    def _fromText(text):
+        "Discard character data"
+
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
     def _iterChildren(self):
         return []
 
+# Common spellings of true, checked before falling back to a case
+# insensitive comparison
+_booleanTrueStrings = frozenset(('true', '1', 'True', 'TRUE'))
+
 class BooleanNode(BaseNode):
     """
     Boolean data class for SAX parser.
@@ -482,8 +721,7 @@ class BooleanNode(BaseNode):
 
     def finalize(self):
         "Convert the character data to a boolean value"
-        text = self.getText()
-        return self.fromString(text)
+        return self._fromText(self.getText())
 
     @staticmethod
     def fromString(stringVal):
@@ -495,7 +733,14 @@ class BooleanNode(BaseNode):
         """
         if isinstance(stringVal, bool):
             return stringVal
-        return stringVal.strip().upper() in ('TRUE', '1')
+        # Values usually come without surrounding white space
+        if stringVal in _booleanTrueStrings:
+            return True
+        stringVal = stringVal.strip()
+        return (stringVal in _booleanTrueStrings
+            or stringVal.lower() == 'true')
+
+    _fromText = fromString
 
     @staticmethod
     def toString(boolVal):
@@ -505,13 +750,72 @@ class BooleanNode(BaseNode):
         @type boolVal: C{bool}
         @rtype: C{str}
         """
-        return boolVal and "true" or "false"
+        return "true" if boolVal else "false"
 
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
     def _iterChildren(self):
         yield self.toString(self.finalize())
 
+class _PrimitiveLeaf(object):
+    """
+    Stand-in for the primitive nodes above while parsing. Finalizing them
+    only keeps a value computed from their text, so there is no need to
+    build the full node, with its children, attributes and namespaces.
+    """
+    __slots__ = ('_name', '_nsMap', '_text', '_fromText', )
+
+    def __init__(self, name, nsMap, fromText):
+        self._name = name
+        self._nsMap = nsMap
+        self._text = None
+        self._fromText = fromText
+
+    def getName(self):
+        "Return the node's name"
+        return self._name
+
+    def getNamespaceMap(self):
+        "Return a copy of the namespace mapping"
+        return self._nsMap.copy()
+
+    def characters(self, ch):
+        "Add character data to this node"
+        text = self._text
+        if text is None:
+            self._text = ch
+        elif isinstance(text, list):
+            text.append(ch)
+        else:
+            # Joined in finalize, same as for nodes
+            self._text = [ text, ch ]
+        return self
+
+    def addChild(self, childNode):
+        "Children are dropped, and so is the text that came before them"
+        self._text = None
+
+    def finalize(self):
+        "Convert the character data to the node's value"
+        text = self._text
+        if text is None:
+            text = ''
+        elif isinstance(text, list):
+            text = u''.join(text)
+        return self._fromText(text)
+
+# Node classes whose value only depends on their text, and the function
+# computing it
+_primitiveNodeTypes = dict((x, x._fromText)
+    for x in (IntegerNode, StringNode, NullNode, BooleanNode))
+# The library's own constructors; classes using them can be built with
+# _fromLxml
+_stockInits = frozenset(x.__init__.im_func
+    for x in (_AbstractNode, IntegerNode, StringNode, NullNode, BooleanNode))
+# Nodes adding children with these can have primitive leaves as children
+_stockAddChildren = frozenset([_AbstractNode.addChild.im_func,
+    _PrimitiveLeaf.addChild.im_func])
+
 #}
 
 
@@ -528,22 +832,93 @@ class SerializableList(list):
         @param parent: An optional parent object.
         @type parent: C{SerializableObject} instance
         """
-        elem = createElementTree(self._getName(), {}, {}, parent = parent)
+        # No attributes and no namespaces: lxml takes None for both, no
+        # need to create empty dictionaries
+        elem = createElementTree(self._getName(), None, parent = parent)
         for child in self:
             child.getElementTree(parent = elem)
         return elem
 
+    def writeTo(self, stream):
+        """
+        Write the XML document for this list to a stream, without building
+        the element tree first.
+        @param stream: the stream (or the name of the file) to write to
+        @type stream: C{file} or C{str}
+        """
+        _writeDocument(self, stream)
+
+    def _openElement(self, xmlFile, xmlDeclared):
+        "Same as C{SerializableObject._openElement}"
+        return xmlFile.element(self._getName()), None, self, xmlDeclared
+
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
     def _getName(self):
         return self.tag
 
+# The classes implementing getElementTree
+_serializableTypes = (SerializableObject, SerializableList)
+# Their getElementTree methods; writeTo walks the objects using them
+# instead of building their element tree
+_stockGetElementTrees = frozenset([_defaultGetElementTree,
+    SerializableList.getElementTree.im_func])
+
+# Slot values serialized as attributes
+_slotAttrTypes = (bool, int, str, unicode)
+
+def _compileSplitData(slots, fieldTypes):
+    """
+    Compile a C{_splitData} function for a C{SlotBasedSerializableObject}
+    class, reading the slots directly instead of looping over them
+    @return: the function, or C{None} if the slots can't be compiled
+    """
+    if not isinstance(slots, (list, tuple)):
+        return None
+    lines = [
+        "def _splitData(self):",
+        "    attrs = {}",
+        "    children = []",
+    ]
+    for fName in slots:
+        lines.append("    fVal = self.%s" % fName)
+        if fieldTypes.get(fName) in _slotAttrTypes:
+            # Declared as an attribute, no need to check the type
+            lines.extend([
+                "    if fVal is not None:",
+                "        attrs[%r] = fVal" % fName,
+            ])
+            continue
+        lines.extend([
+            "    if isinstance(fVal, attrTypes):",
+            "        attrs[%r] = fVal" % fName,
+            "    elif fVal is not None:",
+            "        if not (isinstance(fVal, childTypes) or",
+            "                hasattr(fVal, 'getElementTree')):",
+            "            raise XmlLibError(",
+            "                'Expected an object implementing getElementTree')",
+            "        children.append(fVal)",
+        ])
+    lines.append("    return attrs, children")
+    namespace = dict(attrTypes = _slotAttrTypes,
+        childTypes = (list, SerializableObject), XmlLibError = XmlLibError)
+    try:
+        exec compile('\n'.join(lines), '<_splitData>', 'exec') in namespace
+    except SyntaxError:
+        # Slot names that aren't identifiers; use the generic version
+        return None
+    return namespace['_splitData']
+
 # pylint: disable-msg=R0903
 # Too few public methods (1/2): this is an interface
 class SlotBasedSerializableObject(SerializableObject):
     """
     A serializable object that uses the slots for defining the data that
     has to be serialized to XML
+
+    Subclasses may define a C{_fieldTypes} dictionary mapping slot names
+    to one of C{bool}, C{int}, C{str} or C{unicode}; those slots are then
+    always serialized as attributes, without checking their type.
     """
     __slots__ = []
     tag = None
@@ -575,7 +950,7 @@ class SlotBasedSerializableObject(SerializableObject):
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
     def _iterAttributes(self):
-        return self._splitData()[0].items()
+        return self._splitData()[0].iteritems()
 
     # pylint: disable-msg=C0111
     # docstring inherited from parent class
@@ -588,6 +963,20 @@ class SlotBasedSerializableObject(SerializableObject):
         @return: A tuple (attributes, children)
         @rtype: C{tuple}
         """
+        # Every class gets its own function, compiled for its slots the
+        # first time it is serialized
+        cls = self.__class__
+        func = cls.__dict__.get('_splitDataFunc')
+        if func is None:
+            func = _compileSplitData(self.__slots__,
+                getattr(cls, '_fieldTypes', {}))
+            if func is None:
+                func = SlotBasedSerializableObject._splitSlots.im_func
+            cls._splitDataFunc = func
+        return func(self)
+
+    def _splitSlots(self):
+        "Same as C{_splitData}, looping over the slots"
         attrs = {}
         children = []
         for fName in self.__slots__:
@@ -597,7 +986,7 @@ class SlotBasedSerializableObject(SerializableObject):
             elif fVal is None:
                 # Skip None values
                 continue
-            elif isinstance(fVal, list):
+            elif isinstance(fVal, (list, SerializableObject)):
                 children.append(fVal)
             else:
                 if not hasattr(fVal, "getElementTree"):
@@ -617,26 +1006,6 @@ class ToplevelNode(object):
     @type attrs: C{dict}
     """
 
-    class _FirstTagFound(Exception):
-        pass
-
-    class _Handler(sax.ContentHandler):
-        def __init__(self):
-            sax.ContentHandler.__init__(self)
-            self._name = None
-            self._attrs = None
-
-        def startElement(self, name, attrs):
-            self._name = name
-            self._attrs = dict((k, v) for (k, v) in attrs.items())
-            raise ToplevelNode._FirstTagFound()
-
-        def endElement(self, name):
-            "This method should never be called"
-
-        def characters(self, ch):
-            "This method should never be called"
-
     def __init__(self, stream):
         """
         Read the top-level node.
@@ -656,20 +1025,54 @@ class ToplevelNode(object):
         @param stream: the XML stream
         @type stream: C{str} or C{file}
         """
-        if not hasattr(stream, 'read'):
-            stream = StringIO.StringIO(stream)
+        elem, nsAttrs = self._findElement(stream)
+        if elem is not None:
+            self.name = _LxmlParser._getName(elem)
+            self.attrs = _LxmlParser._getAttributes(elem, nsAttrs)
 
-        contentHandler = self._Handler()
-        parser = sax.make_parser()
-        parser.setContentHandler(contentHandler)
+    @classmethod
+    def _findElement(cls, stream):
+        """
+        Read the stream up to the top-level element.
+        @return: the lxml element (C{None} if the data is malformed), and
+        the namespaces it declares
+        @rtype: C{tuple}
+        """
+        if hasattr(stream, 'read'):
+            chunks = iter(lambda: stream.read(_LxmlParser.BUFFER_SIZE), '')
+        else:
+            chunks = [ stream ]
+
+        # Only read as much as needed to get to the first start tag
+        parser = etree.XMLPullParser(events = ('start-ns', 'start'))
+        nsAttrs = {}
         try:
-            parser.parse(stream)
-        except sax.SAXParseException:
-            return
-        except self._FirstTagFound:
-            self.name = contentHandler._name
-            self.attrs = contentHandler._attrs
-            return
+            for chunk in chunks:
+                parser.feed(chunk)
+                elem = cls._readEvents(parser, nsAttrs)
+                if elem is not None:
+                    return elem, nsAttrs
+            parser.close()
+        except etree.XMLSyntaxError:
+            pass
+        # Pick up the events reported before the end of the data (or before
+        # an error)
+        return cls._readEvents(parser, nsAttrs), nsAttrs
+
+    @staticmethod
+    def _readEvents(parser, nsAttrs):
+        """
+        Look for the top-level node in the parser's events
+        @return: the top-level element, if found
+        @rtype: C{lxml.etree._Element} or None
+        """
+        for event, data in parser.read_events():
+            if event == 'start':
+                return data
+            # start-ns
+            prefix, uri = data
+            nsAttrs[prefix or None] = uri
+        return None
 
     def getAttributesByNamespace(self, namespace):
         """
@@ -689,7 +1092,7 @@ class ToplevelNode(object):
         """
         nsMap = {}
         otherAttrs = {}
-        for k, v in self.attrs.items():
+        for k, v in self.attrs.iteritems():
             arr = k.split(':', 1)
             if arr[0] == 'xmlns':
                 if len(arr) == 1:
@@ -724,6 +1127,8 @@ class BindingHandler(sax.ContentHandler):
         self.typeDict = typeDict
         self.stack = []
         self.rootNode = None
+        # Node classes (see _getClassInfo), keyed on the qualified tag name
+        self._nodeClasses = {}
         sax.ContentHandler.__init__(self)
 
     def registerType(self, typeClass, name = None, namespace = None):
@@ -744,22 +1149,92 @@ class BindingHandler(sax.ContentHandler):
             namespace = getattr(typeClass, 'namespace', None)
 
         self.typeDict[(namespace, name)] = typeClass
+        self._nodeClasses.clear()
+
+    def startDocument(self):
+        "SAX parser callback invoked when parsing starts"
+        # Drop whatever was left over by a document that failed to parse
+        self.stack = []
+        # typeDict may have been changed directly since the last document
+        self._nodeClasses.clear()
 
     def startElement(self, name, attrs):
         "SAX parser callback invoked when a start element event is emitted"
-        classType = GenericNode
-        nameSpace, tagName = splitNamespace(name)
-        if (nameSpace, tagName) in self.typeDict:
-            classType = self.typeDict[(nameSpace, tagName)]
-
-        if self.stack:
-            nsMap = self.stack[-1].getNamespaceMap()
-        else:
-            nsMap = {}
-        newNode = classType(attrs, nsMap = nsMap)
+        classInfo, nsMap = self._getNodeClass(name)
+        newNode = classInfo[0](attrs, nsMap = nsMap)
         newNode.setName(name)
         self.stack.append(newNode)
 
+    def _startElementLxml(self, name, nsAttributes, attrs):
+        """
+        Same as C{startElement}, for attributes that lxml already split
+        into namespace declarations and (namespaceAlias, name) attributes
+        """
+        (classType, fromText, fromLxml), nsMap = self._getNodeClass(name)
+        if fromText is not None and self._takesLeaves():
+            # Subclasses may finalize differently, only the primitive node
+            # types themselves get a stand-in
+            if nsAttributes:
+                nsMap = nsMap.copy()
+                nsMap.update(nsAttributes)
+            self.stack.append(_PrimitiveLeaf(name, nsMap, fromText))
+            return
+        if fromLxml is None:
+            # The class has its own __init__, which may look at the
+            # attributes: build the node the way startElement does
+            newNode = classType(_LxmlParser._joinAttributes(attrs,
+                nsAttributes), nsMap = nsMap)
+            newNode.setName(name)
+            self.stack.append(newNode)
+            return
+        self.stack.append(fromLxml(nsMap, nsAttributes, attrs, name))
+
+    def _takesLeaves(self):
+        """
+        Check whether the current node only finalizes its children, in
+        which case they can be replaced with a C{_PrimitiveLeaf}. Classes
+        overriding C{addChild} may expect the full node.
+        """
+        if not self.stack:
+            return True
+        addChild = getattr(self.stack[-1].addChild, 'im_func', None)
+        return addChild in _stockAddChildren
+
+    def _getNodeClass(self, name):
+        """
+        Return the node class information (see C{_getClassInfo}) and the
+        namespace mapping for a new node
+        """
+        classInfo = self._nodeClasses.get(name)
+        if classInfo is None:
+            classInfo = self._nodeClasses[name] = self._getClassInfo(
+                self.typeDict.get(_splitName(name), GenericNode))
+        if not self.stack:
+            return classInfo, {}
+        parent = self.stack[-1]
+        if isinstance(parent, (_AbstractNode, _PrimitiveLeaf)):
+            # Nodes copy the mapping before adding their own namespaces, so
+            # there is no need to copy it for every node
+            # pylint: disable-msg=W0212
+            return classInfo, parent._nsMap
+        # Other classes implementing the node interface
+        return classInfo, parent.getNamespaceMap()
+
+    @staticmethod
+    def _getClassInfo(classType):
+        """
+        Look at how nodes of a class can be built from lxml's events
+        @return: the class; its text conversion function if the class is
+        one of the primitive node types, or None; its C{_fromLxml}
+        constructor if the class keeps the library's C{__init__}, or None
+        @rtype: C{tuple}
+        """
+        fromLxml = None
+        if (isinstance(classType, type) and
+                getattr(classType.__init__, 'im_func', None) in _stockInits):
+            fromLxml = classType._fromLxml
+        return classType, _primitiveNodeTypes.get(classType), fromLxml
+
     def endElement(self, name):
         "SAX parser callback invoked when an end element event is emitted"
         elem = self._handleEndElement(name)
@@ -802,6 +1277,275 @@ class StreamingBindingHandler(BindingHandler):
     def clear(self):
         return self.generatedNodes.clear()
 
+class _LxmlParser(object):
+    """
+    Parser driving a SAX content handler from lxml's (libxml2) event
+    stream.
+
+    The content handler sees the events the way the SAX parser would
+    report them: with qualified tag names, and with the xmlns declarations
+    as attributes. Like the SAX incremental parser, it can be fed data with
+    C{feed} and C{close}, or it can consume a whole stream with C{parse}.
+
+    One thing differs from the SAX parser, since lxml only keeps the
+    namespace of attributes: when several prefixes are bound to an
+    attribute's namespace, the attribute gets the first of them in
+    alphabetical order, not necessarily the one used in the document.
+    """
+    events = ('start-ns', 'start', 'end')
+    BUFFER_SIZE = 64 * 1024
+    WALK_BATCH_SIZE = 1024
+
+    def __init__(self, contentHandler = None):
+        self._contentHandler = contentHandler
+        self._parser = None
+        self._names = []
+        self._nsAttrs = {}
+        # Element whose text has not been handed to the content handler yet
+        self._textElem = None
+
+    def getContentHandler(self):
+        return self._contentHandler
+
+    def setContentHandler(self, contentHandler):
+        self._contentHandler = contentHandler
+
+    def parse(self, stream):
+        """
+        Parse a stream
+        @raises C{InvalidXML}: if the XML is malformed.
+        """
+        bufferSize = self.BUFFER_SIZE
+        while True:
+            buf = stream.read(bufferSize)
+            if not buf:
+                break
+            self.feed(buf)
+        self.close()
+
+    def walk(self, tree):
+        """
+        Generate the events for an already parsed document
+        @param tree: the document
+        @type tree: C{lxml.etree._ElementTree} or C{lxml.etree._Element}
+        """
+        for _ in self.iterWalk(tree):
+            pass
+
+    def iterWalk(self, tree):
+        """
+        Same as C{walk}, as a generator that stops after every
+        C{WALK_BATCH_SIZE} events, so that what the content handler
+        produced can be used before the rest of the document is walked
+        """
+        self._names = []
+        self._nsAttrs = {}
+        self._textElem = None
+        self._contentHandler.startDocument()
+        events = etree.iterwalk(tree, events = self.events)
+        batchSize = self.WALK_BATCH_SIZE
+        while True:
+            batch = list(itertools.islice(events, batchSize))
+            if not batch:
+                break
+            self._processEvents(batch)
+            yield None
+        self._contentHandler.endDocument()
+
+    def feed(self, data):
+        """
+        Parse a chunk of data
+        @raises C{InvalidXML}: if the XML is malformed.
+        """
+        if self._parser is None:
+            self._parser = etree.XMLPullParser(events = self.events,
+                huge_tree = True)
+            self._names = []
+            self._nsAttrs = {}
+            self._textElem = None
+            self._contentHandler.startDocument()
+        try:
+            self._parser.feed(data)
+        except etree.XMLSyntaxError, e:
+            raise self._convertError(e), None, sys.exc_info()[2]
+        self._processEvents(self._parser.read_events())
+
+    def close(self):
+        """
+        Finish parsing the data passed to C{feed}
+        @raises C{InvalidXML}: if the XML is malformed.
+        """
+        if self._parser is None:
+            raise InvalidXML("No data to parse")
+        parser, self._parser = self._parser, None
+        try:
+            parser.close()
+        except etree.XMLSyntaxError, e:
+            raise self._convertError(e), None, sys.exc_info()[2]
+        self._processEvents(parser.read_events())
+        self._contentHandler.endDocument()
+
+    @staticmethod
+    def _convertError(e):
+        """
+        Convert an lxml parse error to the exception the SAX parser raises
+        @return: C{UndefinedNamespaceError} for undefined attribute
+        prefixes, which libxml2 checks itself, C{InvalidXML} otherwise
+        """
+        if e.code == etree.ErrorTypes.NS_ERR_UNDEFINED_NAMESPACE:
+            # "Namespace prefix b for x on r is not defined"
+            words = e.msg.split()
+            if len(words) > 2:
+                return UndefinedNamespaceError(words[2])
+        return InvalidXML(e)
+
+    def _processEvents(self, events):
+        # This runs for every element: look up everything it needs once
+        contentHandler = self._contentHandler
+        characters = contentHandler.characters
+        endElement = contentHandler.endElement
+        getName = self._getName
+        joinText = self._joinText
+        splitAttributes = self._splitAttributes
+        pushName = self._names.append
+        popName = self._names.pop
+        # Binding handlers can take the attributes the way lxml splits them,
+        # unless startElement was overridden
+        startElementLxml = None
+        if (isinstance(contentHandler, BindingHandler) and
+                contentHandler.startElement.im_func is
+                    BindingHandler.startElement.im_func):
+            startElementLxml = contentHandler._startElementLxml
+        textElem = self._textElem
+        nsAttrs = self._nsAttrs
+        try:
+            for event, data in events:
+                if event == 'start':
+                    if textElem is not None:
+                        # First child; the parent's text is complete now
+                        text = textElem.text
+                        if data.getprevious() is not None:
+                            text = joinText(textElem, data)
+                        if text:
+                            characters(unicode(text))
+                    name = getName(data)
+                    pushName(name)
+                    if startElementLxml is not None:
+                        startElementLxml(name, nsAttrs, splitAttributes(data))
+                    else:
+                        contentHandler.startElement(name,
+                            self._getAttributes(data, nsAttrs))
+                    nsAttrs = {}
+                    textElem = data
+                elif event == 'end':
+                    if textElem is data:
+                        text = data.text
+                        if len(data):
+                            text = joinText(data, None)
+                        if text:
+                            characters(unicode(text))
+                    textElem = None
+                    endElement(popName())
+                    # Drop what we have already processed, to keep memory
+                    # usage flat for large documents
+                    data.clear()
+                    parent = data.getparent()
+                    if parent is not None:
+                        while data.getprevious() is not None:
+                            del parent[0]
+                else:
+                    # start-ns
+                    prefix, uri = data
+                    nsAttrs[_internName(prefix) or None] = _internName(uri)
+        finally:
+            # Events for the rest of the document come with the next feed
+            self._textElem = textElem
+            self._nsAttrs = nsAttrs
+
+    @staticmethod
+    def _joinText(elem, stop):
+        """
+        Return an element's text when it has comments or processing
+        instructions, which keep the text that follows them in their tail
+        @param stop: the first child element, or C{None} if the element has
+        no child elements
+        """
+        text = [ elem.text or '' ]
+        for child in elem:
+            if child is stop:
+                break
+            text.append(child.tail or '')
+        return ''.join(text)
+
+    @staticmethod
+    def _getName(elem):
+        "Return an lxml element's qualified name"
+        # lxml builds a new string every time; interning it lets the name
+        # caches compare by identity
+        tagName = elem.tag.rpartition('}')[2]
+        prefix = elem.prefix
+        if prefix is None:
+            return _internName(tagName)
+        return _qualifiedName(prefix, tagName)
+
+    @classmethod
+    def _getAttributes(cls, elem, nsAttrs):
+        """
+        Convert an lxml element's attributes back to qualified names
+        @param nsAttrs: the namespaces declared by the element, keyed on
+        their alias (C{None} for the default namespace)
+        @type nsAttrs: C{dict}
+        @return: the attributes the way SAX reports them, with the
+        namespace declarations and with namespace prefixes instead of the
+        ElementTree C{{namespace}name} notation
+        @rtype: C{dict}
+        """
+        return cls._joinAttributes(cls._splitAttributes(elem), nsAttrs)
+
+    @staticmethod
+    def _joinAttributes(attrs, nsAttrs):
+        """
+        Same as C{_getAttributes}, for attributes already split
+        @param attrs: the attributes, keyed on (namespaceAlias, name)
+        @type attrs: C{dict}
+        """
+        attrs = dict((unsplitNamespace(attrName, prefix), attrVal)
+            for (prefix, attrName), attrVal in attrs.iteritems())
+        for prefix, uri in nsAttrs.iteritems():
+            if prefix is None:
+                attrs['xmlns'] = uri
+            else:
+                attrs['xmlns:' + prefix] = uri
+        return attrs
+
+    @classmethod
+    def _splitAttributes(cls, elem):
+        """
+        Convert an lxml element's attributes to the node representation
+        @return: the attributes, keyed on (namespaceAlias, name)
+        @rtype: C{dict}
+        """
+        attrs = {}
+        prefixes = None
+        internName = _internName
+        for attrName, attrVal in elem.attrib.iteritems():
+            if attrName[0] == '{':
+                if prefixes is None:
+                    # Attributes can't be in the default namespace, so only
+                    # look at the prefixes. lxml lost the one the attribute
+                    # used; for a namespace bound to several prefixes, use
+                    # the first one
+                    prefixes = { DataBinder.xmlBaseNamespace : 'xml' }
+                    for prefix, uri in sorted(elem.nsmap.iteritems(),
+                            reverse = True):
+                        if prefix is not None:
+                            prefixes[uri] = _internName(prefix)
+                uri, _, attrName = attrName[1:].partition('}')
+                attrs[(prefixes[uri], internName(attrName))] = attrVal
+            else:
+                attrs[(None, internName(attrName))] = attrVal
+        return attrs
+
 class DataBinder(object):
     """
     DataBinder class.
@@ -863,20 +1607,39 @@ class DataBinder(object):
     @cvar xmlSchemaNamespace: Namespace for XML schema. This should not
     change.
     @type xmlSchemaNamespace: C{str}
+    @cvar useSax: If True, parse with the Python SAX parser instead of
+    lxml. Both drive the same content handler. lxml is needed anyway for
+    validation, and lets a validated document be bound without parsing it
+    again. Which parser is faster otherwise depends on the document and
+    on the lxml and expat versions; measure before switching.
+    @type useSax: C{bool}
 
     """
+    # Compiled schemas, keyed on (path, mtime, size) so that a schema file
+    # that changes on disk gets compiled again. Validating fills in the
+    # schema's error log, so every thread has its own cache
+    _schemaCaches = threading.local()
+    _schemaCacheSize = 32
+    # Schema directory listings, keyed on the directory, as (mtime, names)
+    _schemaDirCache = {}
+
     xmlSchemaNamespace = 'http://www.w3.org/2001/XMLSchema-instance'
     xmlBaseNamespace = 'http://www.w3.org/XML/1998/namespace'
     BindingHandlerFactory = BindingHandler
+    useSax = False
 
-    def __init__(self, typeDict = None):
+    def __init__(self, typeDict = None, useSax = None):
         """
         Initialize the Binder object.
 
         @param typeDict: optional type mapping object
         @type typeDict: dict
+        @param useSax: optional override for the class-level C{useSax} flag
+        @type useSax: C{bool}
         """
         self.contentHandler = self.BindingHandlerFactory(typeDict)
+        if useSax is not None:
+            self.useSax = useSax
 
     def registerType(self, klass, name = None, namespace = None):
         """
@@ -908,9 +1671,15 @@ class DataBinder(object):
         @raises C{UnknownSchemaError}: if no valid schema was found
         @raises C{InvalidXML}: if the XML is malformed.
         """
-        stream = StringIO.StringIO(data)
-        return self.parseFile(stream, validate = validate,
-                              schemaDir = schemaDir)
+        if self.useSax:
+            stream = _stringStream(data)
+            return self.parseFile(stream, validate = validate,
+                                  schemaDir = schemaDir)
+        if validate:
+            # Only validation needs a stream; walk the document it parsed
+            return self._parseTree(self._validate(_stringStream(data),
+                schemaDir))
+        return self._parseString(data)
 
     def parseFile(self, stream, validate = False, schemaDir = None):
         """
@@ -930,11 +1699,22 @@ class DataBinder(object):
         """
         if isinstance(stream, str):
             stream = file(stream)
+        seekable = getattr(stream, 'seekable', None)
+        if seekable is not None and not seekable():
+            # Pipes and sockets can't be rewound
+            if not validate:
+                return self._parse(stream)
+            # Validation reads the data more than once, keep a copy
+            stream = _stringStream(stream.read())
         origPos = stream.tell()
         try:
             if validate:
                 stream.seek(0)
-                self.validate(stream, schemaDir = schemaDir)
+                tree = self._validate(stream, schemaDir)
+                if not self.useSax:
+                    # Validation already parsed the document, walk that
+                    # instead of parsing the stream again
+                    return self._parseTree(tree)
             stream.seek(0)
 
             return self._parse(stream)
@@ -953,17 +1733,17 @@ class DataBinder(object):
         the trove.
         @raises C{InvalidXML}: if the XML is malformed.
         """
-        # We need the schema location, so extract the top-level node
-
+        # We need the schema location, so extract the top-level element;
+        # lxml already has its attributes keyed on the namespace
         # Make sure we roll the stream back where it was
         pos = stream.tell()
-        tn = ToplevelNode(stream)
+        elem = ToplevelNode._findElement(stream)[0]
         stream.seek(pos)
 
-        if tn.name is None:
+        if elem is None:
             raise InvalidXML("Possibly malformed XML")
-        attrs = tn.getAttributesByNamespace(cls.xmlSchemaNamespace)
-        schemaLocation = attrs.get('schemaLocation')
+        schemaLocation = elem.get(_elementTreeName(cls.xmlSchemaNamespace,
+            'schemaLocation'))
         if schemaLocation is None:
             raise UnknownSchemaError(
                 "Schema location not specified in XML stream")
@@ -989,18 +1769,41 @@ class DataBinder(object):
             raise UnknownSchemaError("Schema directory `%s' not found" %
                 schemaDir)
 
-        # Pick up the first schema that we could find, in the order they were
-        # specified
-        localFiles = os.listdir(schemaDir)
-
-        possibleSchema = set(schemaFiles).intersection(localFiles)
-        if not possibleSchema:
+        if len(schemaFiles) == 1:
+            # The common case; checking for the one file beats listing the
+            # directory
+            schemaFile = os.path.join(schemaDir, schemaFiles[0])
+            if os.path.isfile(schemaFile):
+                return schemaFile
             raise UnknownSchemaError(
                 "No applicable schema found in directory `%s'" % schemaDir)
-
+        # Pick up the first schema that we could find, in the order they were
+        # specified
+        localFiles = cls._listSchemaDir(schemaDir)
         for sch in schemaFiles:
-            if sch in possibleSchema:
+            if sch in localFiles:
                 return os.path.join(schemaDir, sch)
+        raise UnknownSchemaError(
+            "No applicable schema found in directory `%s'" % schemaDir)
+
+    @classmethod
+    def _listSchemaDir(cls, schemaDir):
+        """
+        List a schema directory. The listing is cached until the
+        directory's modification time changes.
+        @return: the names of the files in the directory
+        @rtype: C{frozenset}
+        """
+        mtime = os.stat(schemaDir).st_mtime
+        entry = cls._schemaDirCache.get(schemaDir)
+        if entry is not None and entry[0] == mtime:
+            return entry[1]
+        localFiles = frozenset(os.listdir(schemaDir))
+        # Timestamps are coarse: a directory changed within the last second
+        # may change again without its mtime moving, so don't trust it yet
+        if time.time() - mtime > 1:
+            cls._schemaDirCache[schemaDir] = (mtime, localFiles)
+        return localFiles
 
     @classmethod
     def validate(cls, stream, schemaDir = None):
@@ -1013,13 +1816,47 @@ class DataBinder(object):
         @raises C{UnknownSchemaError}: if no valid schema was found
         @raises C{InvalidXML}: if the XML is malformed.
         """
+        cls._validate(stream, schemaDir)
+
+    @classmethod
+    def _validate(cls, stream, schemaDir):
+        """
+        Same as C{validate}
+        @return: the parsed document
+        @rtype: C{lxml.etree._ElementTree}
+        """
         validSchema = cls.getSchemaLocationsFromStream(stream)
         schemaFile = cls.chooseSchemaFile(validSchema, schemaDir)
 
-        schema = etree.XMLSchema(file = schemaFile)
+        schema = cls._getSchema(schemaFile)
         tree = etree.parse(stream)
         if not schema.validate(tree):
             raise SchemaValidationError(str(schema.error_log))
+        return tree
+
+    @classmethod
+    def _getSchema(cls, schemaFile):
+        """
+        Return the compiled schema for a file. Compiling a schema is much
+        more expensive than validating against it, so schemas are cached.
+        @param schemaFile: path to the schema file
+        @type schemaFile: C{str}
+        @return: the compiled schema
+        @rtype: C{lxml.etree.XMLSchema}
+        """
+        st = os.stat(schemaFile)
+        key = (os.path.abspath(schemaFile), st.st_mtime, st.st_size)
+        schemaCache = getattr(cls._schemaCaches, 'cache', None)
+        if schemaCache is None:
+            schemaCache = cls._schemaCaches.cache = {}
+        schema = schemaCache.get(key)
+        if schema is None:
+            schema = etree.XMLSchema(file = schemaFile)
+            if len(schemaCache) >= cls._schemaCacheSize:
+                # Nothing fancy, schemas rarely change
+                schemaCache.clear()
+            schemaCache[key] = schema
+        return schema
 
     @classmethod
     def toXml(cls, obj, prettyPrint = True):
@@ -1040,15 +1877,71 @@ class DataBinder(object):
             xml_declaration = True, encoding = 'UTF-8')
         return res
 
+    @classmethod
+    def toXmlStream(cls, obj, stream, prettyPrint = True):
+        """
+        Serialize an object to XML, writing it to a stream instead of
+        returning it as a string.
+
+        @param obj: An object implementing a C{getElementTree} method.
+        @type obj: C{obj}
+        @param stream: the stream (or the name of the file) to write to
+        @type stream: C{file} or C{str}
+        @param prettyPrint: if True (the default), the XML that is produced
+        will be formatted for easier reading by humans (by introducing new
+        lines and white spaces).
+        @type prettyPrint: C{bool}
+        """
+        tree = obj.getElementTree()
+        tree.getroottree().write(stream, pretty_print = prettyPrint,
+            xml_declaration = True, encoding = 'UTF-8')
+
     def _parse(self, stream):
+        if self.useSax:
+            return self._parseSax(stream)
+        return self._parseLxml(stream)
+
+    def _parseSax(self, stream):
         self.contentHandler.rootNode = None
         parser = sax.make_parser()
         parser.setContentHandler(self.contentHandler)
+        # Feed the parser ourselves: parse() closes the stream, and
+        # parseFile still needs it
         try:
-            parser.parse(stream)
-        except sax.SAXParseException:
-            exc_info = sys.exc_info()
-            raise InvalidXML, exc_info[1], exc_info[2]
+            while True:
+                # Always feed at least once, so that empty documents are
+                # reported as such
+                buf = stream.read(_LxmlParser.BUFFER_SIZE)
+                parser.feed(buf)
+                if not buf:
+                    break
+            parser.close()
+        except sax.SAXParseException, e:
+            raise InvalidXML, e, sys.exc_info()[2]
+        rootNode = self.contentHandler.rootNode
+        self.contentHandler.rootNode = None
+        return rootNode
+
+    def _parseLxml(self, stream):
+        self.contentHandler.rootNode = None
+        _LxmlParser(self.contentHandler).parse(stream)
+        rootNode = self.contentHandler.rootNode
+        self.contentHandler.rootNode = None
+        return rootNode
+
+    def _parseTree(self, tree):
+        self.contentHandler.rootNode = None
+        _LxmlParser(self.contentHandler).walk(tree)
+        rootNode = self.contentHandler.rootNode
+        self.contentHandler.rootNode = None
+        return rootNode
+
+    def _parseString(self, data):
+        # lxml takes the string as is, no need for a file object around it
+        self.contentHandler.rootNode = None
+        parser = _LxmlParser(self.contentHandler)
+        parser.feed(data)
+        parser.close()
         rootNode = self.contentHandler.rootNode
         self.contentHandler.rootNode = None
         return rootNode
@@ -1057,31 +1950,59 @@ class StreamingDataBinder(DataBinder):
     BindingHandlerFactory = StreamingBindingHandler
 
     class _Iterator(object):
-        BUFFER_SIZE = 16 * 1024
+        # Larger reads mean fewer feed calls, at the cost of nodes being
+        # produced in bigger batches; same size as the non-streaming parse
+        BUFFER_SIZE = _LxmlParser.BUFFER_SIZE
         def __init__(self, parser, stream):
             self.parser = parser
             self.stream = stream
             self.contentHandler = self.parser.getContentHandler()
             self.contentHandler.clear()
+            self.closed = False
 
         def __iter__(self):
             return self
 
         def next(self):
-            node = self.contentHandler.next()
-            if node is not None:
-                return node
-            buf = self.stream.read(self.BUFFER_SIZE)
-            if not buf:
-                self.parser.close()
-                raise StopIteration()
-            self.parser.feed(buf)
-            return self.next()
+            # Loop rather than recurse: stretches of the document without
+            # any node to yield can span many reads
+            while True:
+                node = self.contentHandler.next()
+                if node is not None:
+                    return node
+                if self.closed:
+                    raise StopIteration()
+                buf = self.stream.read(self.BUFFER_SIZE)
+                if not buf:
+                    # Closing the parser may still produce nodes
+                    self.parser.close()
+                    self.closed = True
+                else:
+                    self.parser.feed(buf)
 
     def _parse(self, stream):
-        parser = sax.make_parser()
-        parser.setContentHandler(self.contentHandler)
+        if self.useSax:
+            parser = sax.make_parser()
+            parser.setContentHandler(self.contentHandler)
+        else:
+            parser = _LxmlParser(self.contentHandler)
         return self._Iterator(parser, stream)
+
+    def _parseTree(self, tree):
+        # Hand out the nodes as the tree is walked, so they don't all have
+        # to be kept around at the same time
+        contentHandler = self.contentHandler
+        contentHandler.clear()
+        generatedNodes = contentHandler.generatedNodes
+        for _ in _LxmlParser(contentHandler).iterWalk(tree):
+            while generatedNodes:
+                # Like the stream parsers, skip nodes finalized to None
+                node = contentHandler.next()
+                if node is not None:
+                    yield node
+
+    def _parseString(self, data):
+        return self._parse(_stringStream(data))
 #}
 
 def splitNamespace(tag):
@@ -1093,10 +2014,70 @@ def splitNamespace(tag):
     the tag name.
     @rtype: C{tuple} (namespace, tagName)
     """
-    arr = tag.split(':', 1)
-    if len(arr) == 1:
+    nsName, sep, tagName = tag.partition(':')
+    if not sep:
         return None, tag
-    return arr[0], arr[1]
+    return nsName, tagName
+
+def _internName(name):
+    """
+    Intern a name or a namespace, since they are repeated throughout a
+    document. Only byte strings can be interned; anything else is returned
+    as is.
+    """
+    if type(name) is str:
+        return intern(name)
+    return name
+
+def _splitName(name):
+    """
+    Same as C{splitNamespace}, with both parts interned. A document uses the
+    same few names over and over, so the result is cached.
+    """
+    split = _splitNames.get(name)
+    if split is None:
+        if len(_splitNames) >= _nameCacheSize:
+            _splitNames.clear()
+        nsName, tagName = splitNamespace(name)
+        split = _splitNames[name] = (_internName(nsName),
+            _internName(tagName))
+    return split
+
+def _elementTreeName(namespace, name):
+    """
+    Build a name in the ElementTree C{{namespace}name} notation. The result
+    is cached and interned, since dispatching compares these names to the
+    ones registered with the dispatcher.
+    """
+    key = (namespace, name)
+    etName = _elementTreeNames.get(key)
+    if etName is None:
+        if len(_elementTreeNames) >= _nameCacheSize:
+            _elementTreeNames.clear()
+        etName = _elementTreeNames[key] = _internName("{%s}%s" % key)
+    return etName
+
+def _qualifiedName(prefix, name):
+    """
+    The reverse of C{_splitName}: join a namespace prefix and a name. The
+    same few names are formatted over and over, so the result is cached.
+    """
+    key = (prefix, name)
+    qualified = _qualifiedNames.get(key)
+    if qualified is None:
+        if len(_qualifiedNames) >= _nameCacheSize:
+            _qualifiedNames.clear()
+        qualified = _qualifiedNames[key] = _internName("%s:%s" % key)
+    return qualified
+
+def _stringStream(data):
+    """
+    Wrap a string in a read-only file-like object. cStringIO is much faster
+    than StringIO, but only handles byte strings correctly.
+    """
+    if isinstance(data, str):
+        return cStringIO.StringIO(data)
+    return StringIO.StringIO(data)
 
 def unsplitNamespace(name, namespace = None):
     """
@@ -1109,7 +2090,7 @@ def unsplitNamespace(name, namespace = None):
     """
     if namespace is None:
         return name
-    return "%s:%s" % (namespace, name)
+    return namespace + ':' + name
 
 def orderItems(items, order):
     """
@@ -1121,16 +2102,34 @@ def orderItems(items, order):
     @return: the ordered list, unknown elements at the end
     @rtype: C{list}
     """
-    # sort key is a three part tuple. each element maps to these rules:
-    # element one reflects if we know how to order the element.
-    # element two reflects the element's position in the ordering.
-    # element three sorts everything else by simply providing the original
-    # item (aka. default ordering of sort)
-    orderHash = dict((y, i) for i, y in enumerate(order))
-    return sorted(items,
-        key = lambda x: (x.getName() not in orderHash,
-                         orderHash.get(x.getName()),
-                         x.getName()))
+    items = list(items)
+    if len(items) < 2:
+        # Nothing to sort
+        return items
+    # Callers tend to pass the same few orderings over and over
+    key = tuple(order)
+    positions = _orderPositions.get(key)
+    if positions is None:
+        if len(_orderPositions) >= 100:
+            _orderPositions.clear()
+        positions = _orderPositions[key] = _getOrderPositions(key)
+    return _orderItems(items, positions)
+
+def _getOrderPositions(order):
+    "Map the names in an ordering to their positions, for _orderItems"
+    return dict((y, i) for i, y in enumerate(order)), len(order)
+
+def _orderItems(items, positions):
+    # sort key is a two part tuple. each element maps to these rules:
+    # element one is the element's position in the ordering, or the length
+    # of the ordering if we don't know how to order the element.
+    # element two sorts everything else by the element's name.
+    # The names are fetched once per item, and the sort is stable.
+    orderHash, unknownPos = positions
+    decorated = [ ((orderHash.get(name, unknownPos), name), x)
+        for x in items for name in (x.getName(), ) ]
+    decorated.sort(key = operator.itemgetter(0))
+    return [ x for (_, x) in decorated ]
 
 def createElementTree(name, attrs, nsMap = None, parent = None):
     """
@@ -1147,13 +2146,59 @@ def createElementTree(name, attrs, nsMap = None, parent = None):
     @return: an element tree
     @rtype: C{etree.Element} instance
     """
-    if nsMap is None:
-        nsMap = {}
-    if parent is not None:
-        elem = etree.SubElement(parent, name, attrs, nsMap)
-    else:
-        elem = etree.Element(name, attrs, nsMap)
-    return elem
+    if parent is None:
+        return etree.Element(name, attrs, nsMap or None)
+    return etree.SubElement(parent, name, attrs, nsMap or None)
+
+# ElementTree names of attributes in the xml namespace start with this
+_xmlNamespacePrefix = '{%s}' % DataBinder.xmlBaseNamespace
+
+def _writeDocument(obj, stream):
+    "Write an object as an XML document, with an incremental XML writer"
+    with etree.xmlfile(stream, encoding = 'UTF-8') as xmlFile:
+        xmlFile.write_declaration()
+        _writeElement(xmlFile, obj)
+
+def _writeElement(xmlFile, obj):
+    """
+    Write an object as an element of an incremental XML writer. Like
+    C{getElementTree}, this walks the tree with a work list instead of
+    recursing, so deep documents don't hit the recursion limit.
+    """
+    # The open elements' contexts, with the iterator over their parent's
+    # children left to write and whether the parent declared the xml prefix
+    stack = []
+    children = iter([ obj ])
+    xmlDeclared = False
+    try:
+        while True:
+            for child in children:
+                if (isinstance(child, _serializableTypes) and
+                        type(child).getElementTree.im_func in
+                            _stockGetElementTrees):
+                    context, text, grandChildren, childXmlDeclared = \
+                        child._openElement(xmlFile, xmlDeclared)
+                    context.__enter__()
+                    stack.append((context, children, xmlDeclared))
+                    if text is not None:
+                        xmlFile.write(text)
+                    children = iter(grandChildren)
+                    xmlDeclared = childXmlDeclared
+                    break
+                # Objects that only implement getElementTree, or that
+                # implement it differently
+                xmlFile.write(child.getElementTree())
+            else:
+                if not stack:
+                    return
+                context, children, xmlDeclared = stack.pop()
+                context.__exit__(None, None, None)
+    except:
+        # Unwind the open elements the way nested with statements would
+        excInfo = sys.exc_info()
+        while stack:
+            stack.pop()[0].__exit__(*excInfo)
+        raise excInfo[0], excInfo[1], excInfo[2]
 
 class NodeDispatcher(object):
     """Simple class that dispatches nodes of various types to various
@@ -1190,15 +2235,9 @@ class NodeDispatcher(object):
         @param namespace: An optional namespace
         @type namespace: C{str} or None
         """
-        if name is None:
-            if not hasattr(typeClass, 'getTag'):
-                return
-            ns, name = splitNamespace(typeClass.getTag())
-        else:
-            ns, name = namespace, name
-
-        key = "{%s}%s" % (self._nsMap.get(ns, ''), name)
-        self._dispatcher[key] = typeClass
+        key = self._getKey(typeClass, name, namespace)
+        if key is not None:
+            self._dispatcher[key] = typeClass
 
     def registerClasses(self, module, baseClass):
         """
@@ -1210,11 +2249,24 @@ class NodeDispatcher(object):
         registered.
         @type baseClass: class
         """
-        for symVal in module.__dict__.itervalues():
-            if not isinstance(symVal, type):
-                continue
-            if issubclass(symVal, baseClass) and symVal != baseClass:
-                self.registerType(symVal)
+        getKey = self._getKey
+        pairs = [ (getKey(x), x) for x in module.__dict__.itervalues()
+            if isinstance(x, type) and x is not baseClass
+                and issubclass(x, baseClass) ]
+        # Classes without a getTag method have no key
+        self._dispatcher.update(x for x in pairs if x[0] is not None)
+
+    def _getKey(self, typeClass, name = None, namespace = None):
+        """
+        Compute the key a class is registered with (see C{registerType})
+        @return: the key, or None if the class has no tag
+        @rtype: C{str} or None
+        """
+        if name is None:
+            if not hasattr(typeClass, 'getTag'):
+                return None
+            namespace, name = splitNamespace(typeClass.getTag())
+        return _elementTreeName(self._nsMap.get(namespace, ''), name)
 
     def dispatch(self, node):
         """
@@ -1222,9 +2274,9 @@ class NodeDispatcher(object):
         the dispatcher.
         """
 
-        absName = node.getAbsoluteName()
-        if absName not in self._dispatcher:
+        # The absolute name is computed when the node's name is set, and
+        # the keys we register use the same {namespace}name notation
+        nodeClass = self._dispatcher.get(node.getAbsoluteName())
+        if nodeClass is None:
             return None
-        nodeClass = self._dispatcher.get(absName)
-
         return nodeClass(node)